@@ -1,16 +1,76 @@
 import sqlite3
-from flask import Flask, render_template, request, jsonify
-import subprocess
+from flask import Flask, Response, render_template, request, jsonify
+import orjson
 import re
-from datetime import datetime, timezone  # ✅ 正确导入
+import asyncio
+import socket
+import threading
+import time
+from datetime import date, datetime, timezone  # ✅ 正确导入
+from apscheduler.schedulers.background import BackgroundScheduler
+from dateutil import parser as date_parser
 
 app = Flask(__name__)
 DB_FILE = 'domains.db'
+MAX_WHOIS_CONCURRENCY = 32  # 并发 WHOIS 查询上限
+CACHE_TTL = 6 * 3600  # 查询结果有效期（秒），过期时间只会在续费时变化
+REFRESH_INTERVAL = 30 * 60  # 后台刷新任务的执行间隔（秒），每次只刷新过期或失败的记录
+
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 15
+WHOIS_RATE = 5  # 每个 WHOIS 服务器每秒最多查询次数，超出容易被注册局限流
+WHOIS_BURST = 10
+IANA_WHOIS_SERVER = 'whois.iana.org'
+
+# 常见顶级域的 WHOIS 服务器，其余通过 IANA 的 refer 字段查找，
+# 查到的结果写入此表和 whois_servers 数据表，之后直连权威服务器
+TLD_WHOIS_SERVERS = {
+    'com': 'whois.verisign-grs.com',
+    'net': 'whois.verisign-grs.com',
+    'org': 'whois.pir.org',
+    'info': 'whois.nic.info',
+    'io': 'whois.nic.io',
+    'cn': 'whois.cnnic.cn',
+    'top': 'whois.nic.top',
+    'xyz': 'whois.nic.xyz',
+}
+
+_local = threading.local()  # 每个线程复用一个 SQLite 连接
+_buckets = {}  # WHOIS 服务器 -> TokenBucket
+_buckets_lock = threading.Lock()
+_lookup_memo = {}  # 域名 -> (小时, 查询结果)
+_scheduler = None  # 后台刷新调度器，由 start_scheduler() 创建
+_missing_tlds = {}  # IANA 未返回 WHOIS 服务器的顶级域 -> 查询时间，只存内存，CACHE_TTL 后重新询问
 
 
 # --- 数据库处理 ---
+# 查询结果直接存放在 domains 行上，读取时由 SQL 计算剩余天数和状态
+RESULT_COLUMNS = {
+    'expiration_date': 'TEXT',
+    'registrar': 'TEXT',
+    'fetched_at': 'INTEGER',
+    'last_error': 'TEXT',
+    'last_status': 'TEXT',
+}
+
+
+def get_conn():
+    # 连接随线程存活：gthread worker 的请求线程和调度器线程各自复用同一个连接
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE)
+        # WAL 模式下后台刷新写入时，页面请求仍可并发读取
+        conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA cache_size=-20000;
+        ''')
+        _local.conn = conn
+    return conn
+
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_conn() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS domains (
@@ -18,152 +78,333 @@ def init_db():
                 name TEXT UNIQUE NOT NULL
             )
         ''')
+        # 旧库升级：补齐结果列
+        existing = {row[1] for row in cursor.execute("PRAGMA table_info(domains)")}
+        for column, column_type in RESULT_COLUMNS.items():
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE domains ADD COLUMN {column} {column_type}")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS whois_servers (
+                tld TEXT PRIMARY KEY,
+                server TEXT NOT NULL
+            )
+        ''')
         conn.commit()
 
 
-def get_stored_domains():
-    with sqlite3.connect(DB_FILE) as conn:
+def get_domains_with_cache():
+    # 一条语句取回全部域名及其查询结果，避免逐个域名查库
+    with get_conn() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM domains")
+        cursor.execute('''
+            SELECT id, name, expiration_date, registrar, fetched_at, last_error, days_left,
+                CASE
+                    WHEN expiration_date IS NULL THEN last_status
+                    WHEN days_left < 0 THEN 'expired'
+                    WHEN days_left < 30 THEN 'critical'
+                    WHEN days_left < 90 THEN 'warning'
+                    ELSE 'good'
+                END AS status
+            FROM (
+                SELECT *,
+                    CAST(julianday(expiration_date) - julianday('now', 'start of day') AS INTEGER) AS days_left
+                FROM domains
+            )
+        ''')
         return cursor.fetchall()
 
 
+def get_stale_domains(ttl=CACHE_TTL):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, name FROM domains
+            WHERE fetched_at IS NULL
+                OR last_error IS NOT NULL
+                OR fetched_at < strftime('%s', 'now') - ?
+        ''', (ttl,))
+        return cursor.fetchall()
+
+
+def save_domain_info(domain_id, info, fetched_at):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        if info.get("error") is None:
+            cursor.execute('''
+                UPDATE domains
+                SET expiration_date = ?, registrar = ?, fetched_at = ?, last_error = NULL, last_status = NULL
+                WHERE id = ?
+            ''', (info["expiration_date"], info["registrar"], fetched_at, domain_id))
+        else:
+            # 查询失败时保留上次的过期时间，只记录错误
+            cursor.execute('''
+                UPDATE domains
+                SET fetched_at = ?, last_error = ?, last_status = ?
+                WHERE id = ?
+            ''', (fetched_at, info["error"], info["status"], domain_id))
+        conn.commit()
+
+
+def get_stored_whois_server(tld):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT server FROM whois_servers WHERE tld = ?", (tld,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def save_whois_server(tld, server):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO whois_servers (tld, server) VALUES (?, ?)", (tld, server))
+        conn.commit()
+
+
 def add_stored_domain(domain_name):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO domains (name) VALUES (?)", (domain_name,))
             conn.commit()
-            return True
+            return cursor.lastrowid
     except sqlite3.IntegrityError:
-        return False
+        return None
 
 
 def delete_stored_domain(domain_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM domains WHERE id = ?", (domain_id,))
         conn.commit()
 
 
 # --- 解析 WHOIS 输出中的过期时间 ---
-def parse_expiry_from_whois_output(output):
-    lines = output.split('\n')
-    expiry_keywords = [
-        'expire', 'expiration', 'registry exp', 'paid-till',
-        '过期时间', '过期日期', 'expiry date', 'renewal date'
-    ]
-    date_patterns = [
-        r'\d{4}-\d{2}-\d{2}',          # 2025-08-14
-        r'\d{2}-\d{2}-\d{4}',          # 14-08-2025
-        r'\d{2}/\d{2}/\d{4}',          # 08/14/2025
-        r'\d{4}\.\d{2}\.\d{2}',        # 2025.08.14
-    ]
-    
-    for line in lines:
-        line_lower = line.lower()
-        if any(kw in line_lower for kw in expiry_keywords):
-            for pattern in date_patterns:
-                match = re.search(pattern, line)
-                if match:
-                    date_str = match.group()
-                    if re.match(r'\d{4}-\d{2}-\d{2}', date_str):
-                        return date_str
-                    elif re.match(r'\d{2}-\d{2}-\d{4}', date_str):
-                        parts = date_str.split('-')
-                        return f"{parts[2]}-{parts[0]}-{parts[1]}"
-                    elif re.match(r'\d{2}/\d{2}/\d{4}', date_str):
-                        parts = date_str.split('/')
-                        return f"{parts[2]}-{parts[0]}-{parts[1]}"
-                    elif re.match(r'\d{4}\.\d{2}\.\d{2}', date_str):
-                        return date_str.replace('.', '-')
+# 关键字须出现在字段名（冒号之前），避免命中字段值中的同名词；
+# 直接在原始字节上匹配，捕获关键字之后含数字的行尾，只对这一小段解码
+EXPIRY_KEYWORDS = [
+    'expire', 'expiration', 'registry exp', 'paid-till',
+    '过期时间', '过期日期', 'expiry date', 'renewal date'
+]
+EXPIRY_RE = re.compile(
+    rb'(?im)^[^\n:]*?'
+    rb'(?:' + b'|'.join(re.escape(kw.encode('utf-8')) for kw in EXPIRY_KEYWORDS) + rb')'
+    rb'(?P<tail>[^\n]*\d[^\n]*)'
+)
+
+# 这些注册局以 日/月/年 输出日期，解析 01/02/2025 之类有歧义的日期时日在前
+DAYFIRST_TLDS = {'fr', 'bg', 'uk', 'br', 'au', 'nz', 'in', 'it', 'es', 'nl', 'be', 'eu'}
+
+# dateutil 会用 default 补齐文本中缺失的年月日；用不可能出现的年份作哨兵，
+# 以识别 "Expiration Grace Period: 30 days" 这类并不包含日期的行
+_MISSING_DATE = datetime(1, 1, 1)
+
+
+def _parse_iso_date(value):
+    # 绝大多数注册局输出 ISO-8601（2025-08-14T04:00:00Z），按固定位置切片，无需 dateutil 猜格式
+    if len(value) < 10 or value[4] != '-' or value[7] != '-':
+        return None
+    try:
+        return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        return None
+
+
+def parse_expiry_from_whois_output(output, dayfirst=False):
+    for match in EXPIRY_RE.finditer(output):
+        tail = match.group('tail').decode('utf-8', 'replace')
+        exp_date = _parse_iso_date(tail.split(':', 1)[-1].strip())
+        if exp_date is not None:
+            return exp_date
+        try:
+            exp_date = date_parser.parse(
+                tail, default=_MISSING_DATE, fuzzy=True, dayfirst=dayfirst, ignoretz=True
+            )
+        except (ValueError, OverflowError):
+            continue
+        if exp_date.year == _MISSING_DATE.year:
+            continue
+        return exp_date.date()
     return None
 
 
+# --- WHOIS 协议（TCP 43 端口）---
+REFER_RE = re.compile(rb'(?im)^(?:refer|whois):[ \t]*(\S+)')
+
+
+class TokenBucket:
+    """令牌桶：按 rate 每秒补充令牌，最多积攒 capacity 个，取不到令牌时异步等待"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        # 定时任务和添加域名可能在不同线程各自运行事件循环，状态仍用线程锁保护
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+def get_bucket(server):
+    with _buckets_lock:
+        bucket = _buckets.get(server)
+        if bucket is None:
+            bucket = _buckets[server] = TokenBucket(WHOIS_RATE, WHOIS_BURST)
+    return bucket
+
+
+async def whois_query(server, query):
+    # 同一注册局的域名并发查询时按服务器限速，避免被拒绝或封禁
+    await get_bucket(server).acquire()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(server, WHOIS_PORT), WHOIS_TIMEOUT)
+    try:
+        writer.write(query.encode('idna') + b'\r\n')
+        await writer.drain()
+        # 服务器发送完毕后会主动关闭连接
+        return await asyncio.wait_for(reader.read(), WHOIS_TIMEOUT)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            # 对端已重置连接等关闭阶段的错误不影响已读到的结果
+            pass
+
+
+async def find_whois_server(tld):
+    server = TLD_WHOIS_SERVERS.get(tld)
+    if server is None:
+        server = get_stored_whois_server(tld)
+    if server is None:
+        missing_since = _missing_tlds.get(tld)
+        if missing_since is not None and time.time() - missing_since < CACHE_TTL:
+            return None
+        match = REFER_RE.search(await whois_query(IANA_WHOIS_SERVER, tld))
+        if not match:
+            # 可能只是 IANA 临时限流，不写入数据库，过一段时间再询问
+            _missing_tlds[tld] = time.time()
+            return None
+        server = match.group(1).decode('ascii')
+        save_whois_server(tld, server)
+        _missing_tlds.pop(tld, None)
+    TLD_WHOIS_SERVERS[tld] = server
+    return server
+
+
 # --- 查询域名信息 ---
-def get_domain_info(domain_id, domain_name):
+async def get_domain_info(domain_name):
     try:
-        result = subprocess.run(
-            ['whois', domain_name],
-            capture_output=True,
-            text=True,
-            timeout=15
-        )
-
-        if result.returncode != 0:
-            error_msg = result.stderr.strip() or "WHOIS 命令执行失败"
+        tld = domain_name.rsplit('.', 1)[-1]
+        server = await find_whois_server(tld)
+        if not server:
             return {
-                "id": domain_id,
-                "domain": domain_name,
-                "error": f"执行错误: {error_msg}",
-                "status": "error"
+                    "domain": domain_name,
+                "error": f"未找到 .{tld} 的 WHOIS 服务器",
+                "status": "unknown"
             }
 
-        expiry_date_str = parse_expiry_from_whois_output(result.stdout)
-        if not expiry_date_str:
+        output = await whois_query(server, domain_name)
+        exp_date = parse_expiry_from_whois_output(output, dayfirst=tld in DAYFIRST_TLDS)
+        if exp_date is None:
             return {
-                "id": domain_id,
-                "domain": domain_name,
+                    "domain": domain_name,
                 "error": "未在 WHOIS 中找到过期时间（可能域名未注册或格式不支持）",
                 "status": "unknown"
             }
 
-        try:
-            exp_date = datetime.strptime(expiry_date_str, '%Y-%m-%d')
-        except ValueError:
-            return {
-                "id": domain_id,
-                "domain": domain_name,
-                "error": f"无法解析日期格式: {expiry_date_str}",
-                "status": "error"
-            }
-
-        # ✅ 使用 timezone.utc（小写）—— 兼容所有 Python 3.6+
-        now = datetime.now(timezone.utc)
-        days_left = (exp_date.date() - now.date()).days
-
-        if days_left < 0:
-            status = "expired"
-        elif days_left < 30:
-            status = "critical"
-        elif days_left < 90:
-            status = "warning"
-        else:
-            status = "good"
-
+        # 剩余天数和状态由 get_domains_with_cache 在读取时用 SQL 计算
         return {
-            "id": domain_id,
             "domain": domain_name,
-            "expiration_date": expiry_date_str,
-            "days_left": days_left,
+            "expiration_date": exp_date.isoformat(),
             "registrar": "（未解析注册商）",
-            "status": status,
             "error": None
         }
 
-    except subprocess.TimeoutExpired:
+    except (asyncio.TimeoutError, socket.timeout):
         return {
-            "id": domain_id,
             "domain": domain_name,
             "error": "WHOIS 查询超时（网络或服务器无响应）",
             "status": "timeout"
         }
-    except FileNotFoundError:
+    except OSError as e:
         return {
-            "id": domain_id,
             "domain": domain_name,
-            "error": "系统缺少 'whois' 命令，请运行: sudo apt install whois",
+            "error": f"连接 WHOIS 服务器失败: {e}",
             "status": "error"
         }
     except Exception as e:
         return {
-            "id": domain_id,
             "domain": domain_name,
             "error": f"未知错误: {str(e)}",
             "status": "error"
         }
 
 
+# --- 刷新查询结果 ---
+# 同一小时内同一域名只查询一次：查询失败的域名每轮定时刷新都会重试，
+# 这里避免反复请求 WHOIS 服务器而被限流
+async def lookup_domain_info(domain_id, domain_name, now):
+    hour = int(now.timestamp() // 3600)
+    cached = _lookup_memo.get(domain_name)
+    if cached is None or cached[0] != hour:
+        cached = _lookup_memo[domain_name] = (hour, await get_domain_info(domain_name))
+    info = dict(cached[1])
+    info["id"] = domain_id
+    return info
+
+
+async def _lookup_all(domains, now):
+    semaphore = asyncio.Semaphore(MAX_WHOIS_CONCURRENCY)
+
+    async def lookup(domain_id, domain_name):
+        async with semaphore:
+            return await lookup_domain_info(domain_id, domain_name, now)
+
+    return await asyncio.gather(*(lookup(d_id, d_name) for d_id, d_name in domains))
+
+
+def refresh_domains(domains):
+    if not domains:
+        return
+    # 各域名查询互不依赖且以网络等待为主，在同一事件循环中并发执行，总耗时约等于最慢的一次查询
+    # 整批共用同一个当前时间：fetched_at 和查询缓存的小时分桶在批内一致
+    now = datetime.now(timezone.utc)
+    results = asyncio.run(_lookup_all(domains, now))
+    fetched_at = int(now.timestamp())
+    for info in results:
+        save_domain_info(info["id"], info, fetched_at)
+
+
+def refresh_stale_domains():
+    refresh_domains(get_stale_domains())
+
+
+def start_scheduler():
+    global _scheduler
+    # 查询 WHOIS 只在后台进行，接口请求只读数据库，不受 WHOIS 服务器延迟和限流影响
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        refresh_stale_domains, 'interval',
+        seconds=REFRESH_INTERVAL,
+        next_run_time=datetime.now(),  # 启动时立即执行一次
+        max_instances=1,
+        coalesce=True
+    )
+    scheduler.start()
+    _scheduler = scheduler
+    return scheduler
+
+
 # --- Flask 路由 ---
 @app.route('/')
 def home():
@@ -172,12 +413,36 @@ def home():
 
 @app.route('/api/domains', methods=['GET'])
 def get_domains():
-    stored_domains = get_stored_domains()
     results = []
-    for d_id, d_name in stored_domains:
-        info = get_domain_info(d_id, d_name)
-        results.append(info)
-    return jsonify(results)
+    for d_id, d_name, exp_date, registrar, fetched_at, error, days_left, status in get_domains_with_cache():
+        if fetched_at is None:
+            results.append({
+                "id": d_id,
+                "domain": d_name,
+                "status": "pending",
+                "error": None
+            })
+        elif exp_date is None:
+            results.append({
+                "id": d_id,
+                "domain": d_name,
+                "error": error,
+                "status": status
+            })
+        else:
+            # 已知过期时间时，最近一次查询失败只作为提示附带返回，不影响展示
+            results.append({
+                "id": d_id,
+                "domain": d_name,
+                "expiration_date": exp_date,
+                "days_left": days_left,
+                "registrar": registrar,
+                "status": status,
+                "last_error": error,
+                "error": None
+            })
+    # 列表可能有数百条，用 orjson 直接编码为 bytes，比 jsonify 快数倍
+    return Response(orjson.dumps(results), mimetype='application/json')
 
 
 @app.route('/api/domains', methods=['POST'])
@@ -187,25 +452,35 @@ def add_domain():
     if not domain:
         return jsonify({"success": False, "message": "域名不能为空"}), 400
 
-    domain = domain.lower().strip().replace('http://', '').replace('https://', '').split('/')[0]
+    domain = domain.strip().lower().removeprefix('https://').removeprefix('http://').split('/', 1)[0]
 
     if not domain or '.' not in domain:
         return jsonify({"success": False, "message": "无效域名格式"}), 400
 
-    if add_stored_domain(domain):
-        return jsonify({"success": True, "message": "添加成功"})
-    else:
+    domain_id = add_stored_domain(domain)
+    if domain_id is None:
         return jsonify({"success": False, "message": "域名已存在"}), 400
 
+    # 新域名交给后台立即查询一次，无需等待下一轮定时任务；接口本身不等待 WHOIS
+    _lookup_memo.clear()
+    if _scheduler is not None:
+        _scheduler.add_job(refresh_domains, args=[[(domain_id, domain)]])
+    else:
+        # 未通过 __main__ 或 gunicorn_conf.py 启动（如 flask run）时没有调度器，改用后台线程查询
+        app.logger.warning("后台调度器未启动，域名不会定时刷新；请调用 start_scheduler()")
+        threading.Thread(target=refresh_domains, args=([(domain_id, domain)],), daemon=True).start()
+    return jsonify({"success": True, "message": "添加成功"})
+
 
 @app.route('/api/domains/<int:domain_id>', methods=['DELETE'])
 def delete_domain(domain_id):
     delete_stored_domain(domain_id)
+    _lookup_memo.clear()
     return jsonify({"success": True})
 
 
 if __name__ == '__main__':
     init_db()
-    print("✅ 域名到期监控服务启动（使用系统 WHOIS）")
-    print("💡 请确保已安装 'whois'：sudo apt install whois")
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    start_scheduler()
+    print("✅ 域名到期监控服务启动（直连 WHOIS 服务器）")
+    app.run(port=5000, host='0.0.0.0')
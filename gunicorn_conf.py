@@ -0,0 +1,14 @@
+# 生产环境启动：gunicorn -c gunicorn_conf.py app:app
+# WHOIS 查询在 asyncio 事件循环中进行，与 gevent 的 monkey patch 不兼容，使用线程 worker；
+# 接口只读 SQLite，少量线程即可处理并发请求
+bind = '0.0.0.0:5000'
+worker_class = 'gthread'
+# 后台刷新任务运行在 worker 内，多个 worker 会重复查询 WHOIS
+workers = 1
+threads = 8
+
+
+def post_worker_init(worker):
+    from app import init_db, start_scheduler
+    init_db()
+    start_scheduler()